@@ -1,16 +1,19 @@
 # __init__.py
 import os
 import secrets
-from flask import Flask
+from functools import lru_cache
+from flask import Flask, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
+from flask_bcrypt import Bcrypt
 from flask_mail import Mail
-from dotenv import load_dotenv
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
 
 from flaskr.utils.template_filters import replace_newline
 
-load_dotenv(override=True)
 login_manager = LoginManager()
 login_manager.login_view = 'app.view'
 login_manager.login_message = 'ログインをお願いします'
@@ -18,8 +21,77 @@ login_manager.login_message = 'ログインをお願いします'
 basedir = os.path.abspath(os.path.dirname(__name__))
 db = SQLAlchemy()
 migrate = Migrate()
+bcrypt = Bcrypt()
 mail = Mail()
 
+@lru_cache(maxsize=None)
+def _load_dotenv():
+  """
+  .envファイルを環境変数に1度だけ読み込みます。
+
+  Returns: None
+  """
+  from dotenv import load_dotenv
+  load_dotenv(override=True)
+
+@lru_cache(maxsize=None)
+def _get_secret_key():
+  """
+  アプリケーションの秘密鍵を返します。
+
+  環境変数SECRET_KEYを優先し、未設定の場合はプロセスごとに1度だけ生成した鍵を使います。
+  create_app()を呼ぶたびに鍵が変わり、セッションが無効になることを防ぎます。
+
+  Returns:
+    str: 秘密鍵。
+
+  Raises:
+    RuntimeError: SECRET_KEYが未設定で、複数のワーカー(WEB_CONCURRENCY > 1)で起動しようとした場合。
+      ワーカーごとに鍵が異なると、別のワーカーが署名したセッションやCSRFトークンを受け付けられないため。
+  """
+  _load_dotenv()
+  secret_key = os.getenv('SECRET_KEY')
+  if secret_key:
+    return secret_key
+  if int(os.getenv('WEB_CONCURRENCY', '1')) > 1:
+    raise RuntimeError('複数のワーカーで起動する場合は環境変数SECRET_KEYを設定してください')
+  return secrets.token_hex(16)
+
+@lru_cache(maxsize=None)
+def _load_mail_config():
+  """
+  .envファイルを読み込み、メール設定を1度だけ解析して返します。
+
+  create_app()が繰り返し呼ばれても.envの読み込みと値の変換は初回のみ行われます。
+
+  Returns:
+    dict: Flask-Mailの設定値。
+  """
+  _load_dotenv()
+  return {
+    'MAIL_SERVER': os.getenv('MAIL_SERVER'),
+    'MAIL_PORT': int(os.getenv('MAIL_PORT')),
+    'MAIL_USE_TLS': os.getenv('MAIL_USE_TLS').lower() == 'true',
+    'MAIL_USE_SSL': os.getenv('MAIL_USE_SSL').lower() == 'true',
+    'MAIL_USERNAME': os.getenv('MAIL_USERNAME'),
+    'MAIL_PASSWORD': os.getenv('MAIL_PASSWORD'),
+    'MAIL_DEFAULT_SENDER': os.getenv('MAIL_DEFAULT_SENDER'),
+  }
+
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+  """
+  SQLiteへの接続ごとに書き込み性能を上げるPRAGMAを設定します。
+
+  WALモードとsynchronous=NORMALでコミットごとのfsyncを減らし、
+  一時テーブルはメモリ上に置き、ページの読み込みにはmmapを使います。
+  """
+  cursor = dbapi_connection.cursor()
+  cursor.execute('PRAGMA journal_mode=WAL')
+  cursor.execute('PRAGMA synchronous=NORMAL')
+  cursor.execute('PRAGMA temp_store=MEMORY')
+  cursor.execute('PRAGMA mmap_size=268435456')
+  cursor.close()
+
 def create_app():
   """
     Flaskアプリケーションを作成し、設定します。
@@ -37,26 +109,57 @@ def create_app():
       app.run(debug=True)
     """
   app = Flask(__name__)
-  app.config['SECRET_KEY'] = secrets.token_hex(16)
+  app.config['SECRET_KEY'] = _get_secret_key()
   app.config['SQLALCHEMY_DATABASE_URI'] = \
     'sqlite:////' + os.path.join(basedir, 'data.sqlite')
   app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+  # gunicornはgthreadワーカーで動かすため、リクエストごとに接続してPRAGMAを設定し直さないよう
+  # ワーカーのスレッド数と同じだけ接続をプールして使い回す(WALモードでは読み取りは並行して行える)
+  # 接続は別のスレッドに貸し出されるため、sqlite3の同一スレッド制限は外す
+  # 検索やメッセージ取得などの文は値をバインドパラメータで渡しているため、
+  # コンパイル済みSQLのキャッシュを既定の500件より大きくして再コンパイルを防ぐ
+  app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': QueuePool,
+    'pool_size': int(os.environ.get('GUNICORN_THREADS', 4)),
+    'max_overflow': 4,
+    'connect_args': {'check_same_thread': False},
+    'query_cache_size': 1200,
+  }
+  # bcryptのコスト。ログインの待ち時間を抑えつつ、OWASPの推奨下限(10)を守る
+  app.config['BCRYPT_LOG_ROUNDS'] = 10
   # Flask アプリケーションのメール設定
-  app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER')
-  app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT'))
-  app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS').lower() == 'true'
-  app.config['MAIL_USE_SSL'] = os.getenv('MAIL_USE_SSL').lower() == 'true'
-  app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
-  app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
-  app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER')
+  app.config.update(_load_mail_config())
 
   from flaskr.views import bp # viewsで定義するbpをインポート
   
   app.register_blueprint(bp)
+  # リクエストごとにユーザー検索のキャッシュを初期化
+  @app.before_request
+  def reset_user_cache():
+    g._user_by_email_cache = {}
+    g._user_cache = {}
+    g._is_friend_cache = {}
+
+  # 期限切れトークンをまとめて削除するコマンド (cronやHeroku Schedulerから定期実行する)
+  # 例: flask --app app prune-tokens
+  @app.cli.command('prune-tokens')
+  def prune_tokens_command():
+    from flaskr.models import PasswordResetToken
+    PasswordResetToken.prune_expired()
+
   app.add_template_filter(replace_newline)
+  # コンパイル済みテンプレートをインスタンスフォルダに保存し、ワーカーの再起動後も再コンパイルしない
+  # (共有の一時ディレクトリは他のJinjaアプリとキャッシュファイルが混ざるため使わない)
+  # (TEMPLATES_AUTO_RELOADは未設定のままにし、debug時だけテンプレートの変更を検知させる)
+  jinja_cache_dir = os.path.join(app.instance_path, 'jinja_cache')
+  os.makedirs(jinja_cache_dir, exist_ok=True)
+  app.jinja_env.bytecode_cache = FileSystemBytecodeCache(jinja_cache_dir)
   db.init_app(app)
+  with app.app_context():
+    event.listen(db.engine, 'connect', _set_sqlite_pragma)
   migrate.init_app(app, db)
   login_manager.init_app(app)
+  bcrypt.init_app(app)
   mail.init_app(app)
   
   return app
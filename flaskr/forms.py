@@ -1,16 +1,39 @@
 # forms.py
-from collections.abc import Mapping, Sequence
-from typing import Any
+import hmac
 from flask_wtf import FlaskForm
 from wtforms.fields import (
   StringField, FileField, PasswordField, SubmitField, HiddenField, TextAreaField
 )
-from wtforms.validators import DataRequired, Email, EqualTo
-from wtforms import ValidationError, validators
+from wtforms.validators import DataRequired, Email, Length
+from wtforms import ValidationError
 from flaskr.models import User, UserConnect
 from flask_login import current_user
 from flask import flash
 
+# バリデータは状態を持たないため、モジュール読み込み時に1度だけ生成して各フォームで共有する
+REQUIRED = DataRequired()
+EMAIL_VALIDATOR = Email('メールアドレスに誤りがあります')
+PASSWORD_LENGTH = Length(min=10, message='パスワードは10文字以上で入力してください')
+
+def confirm_password_matches(form):
+  """
+  パスワードと確認用パスワードが一致するか検証する関数。
+
+  両フィールドの値を1度ずつ読み、hmac.compare_digestで一定時間の比較を行います。
+
+  Args:
+    form (FlaskForm): passwordとconfirm_passwordを持つフォームのインスタンス。
+
+  Returns:
+    bool: 一致すればTrue、一致しなければエラーメッセージを追加してFalse。
+  """
+  password = form.password.data.encode('utf-8')
+  confirm_password = form.confirm_password.data.encode('utf-8')
+  if not hmac.compare_digest(password, confirm_password):
+    form.confirm_password.errors.append('パスワードが一致しません')
+    return False
+  return True
+
 class LoginForm(FlaskForm):
   """
   ログインフォームを表すWTFormsフォームクラス。
@@ -20,8 +43,8 @@ class LoginForm(FlaskForm):
     password (PasswordField): パスワードを入力するフィールド。
     submit (SubmitField): ログインを実行するための送信ボタン。
   """
-  email = StringField('メール：', validators=[DataRequired(), Email()])
-  password = PasswordField('パスワード', validators=[DataRequired()])
+  email = StringField('メール：', validators=[REQUIRED, EMAIL_VALIDATOR])
+  password = PasswordField('パスワード', validators=[REQUIRED])
   submit = SubmitField('ログイン')
 
 class RegisterForm(FlaskForm):
@@ -40,9 +63,9 @@ class RegisterForm(FlaskForm):
   """
   email = StringField(
     'メールアドレス：',
-    validators=[DataRequired(), Email('メールアドレスに誤りがあります')]
+    validators=[REQUIRED, EMAIL_VALIDATOR]
   )
-  username = StringField('ユーザー名：', validators=[DataRequired()])
+  username = StringField('ユーザー名：', validators=[REQUIRED])
   submit = SubmitField('登録')
   
   # 登録済みのメールアドレスは登録できないvalidateを作成
@@ -61,20 +84,16 @@ class ResetPasswordForm(FlaskForm):
     submit (SubmitField): フォームを送信するためのボタン。
 
   Methods:
-    validate_confirm_password: パスワードと確認用パスワードの一致を確認するメソッド。
-    validate_password: パスワードが指定の条件を満たしているか検証するメソッド。
+    validate: パスワードと確認用パスワードの一致を確認するメソッド。
   """
-  password = PasswordField('パスワード：', validators=[DataRequired()])
-  confirm_password = PasswordField('パスワード確認：', validators=[DataRequired()])
+  password = PasswordField('パスワード：', validators=[REQUIRED, PASSWORD_LENGTH])
+  confirm_password = PasswordField('パスワード確認：', validators=[REQUIRED])
   submit = SubmitField('パスワード更新')
   
-  def validate_confirm_password(form, field):
-    if form.password.data != field.data:
-      raise ValidationError('パスワードが一致しません')
-  
-  def validate_password(self, field):
-    if len(field.data) < 10:
-      raise ValidationError('パスワードは10文字以上で入力してください')
+  def validate(self):
+    if not super(FlaskForm, self).validate():
+      return False
+    return confirm_password_matches(self)
 
 class ForgotPasswordForm(FlaskForm):
   """
@@ -87,7 +106,7 @@ class ForgotPasswordForm(FlaskForm):
   Methods:
     validate_email: 入力されたメールアドレスが存在するか検証するメソッド。
   """
-  email = StringField('メールアドレス：', validators=[DataRequired()])
+  email = StringField('メールアドレス：', validators=[REQUIRED])
   submit = SubmitField('パスワードを再設定する')
   
   def validate_email(self, field):
@@ -106,9 +125,9 @@ class UserForm(FlaskForm):
   """
   email = StringField(
     'メールアドレス：',
-    validators=[DataRequired(), Email('メールアドレスに誤りがあります')]
+    validators=[REQUIRED, EMAIL_VALIDATOR]
   )
-  username = StringField('ユーザー名：', validators=[DataRequired()])
+  username = StringField('ユーザー名：', validators=[REQUIRED])
   picture_path = FileField('プロフィール画像')
   submit = SubmitField('登録情報更新')
   
@@ -137,35 +156,22 @@ class ChangePasswordForm(FlaskForm):
     confirm_password (PasswordField): パスワード確認のための入力フィールド。
     submit (SubmitField): フォームの送信ボタン。
   """
-  password = PasswordField('更新パスワード：', validators=[DataRequired()])
-  confirm_password = PasswordField('パスワード確認：', validators=[DataRequired()])
+  password = PasswordField('更新パスワード：', validators=[REQUIRED, PASSWORD_LENGTH])
+  confirm_password = PasswordField('パスワード確認：', validators=[REQUIRED])
   submit = SubmitField('パスワードを更新する')
   
-  def validate_confirm_password(form, field):
-    """
-    パスワード確認のバリデーションメソッド。
-
-    Args:
-      form (ChangePasswordForm): フォームのインスタンス。
-      field (PasswordField): パスワード確認の入力フィールド。
-
-    Raises:
-      ValidationError: パスワードが一致しない場合に発生。
-    """
-    if form.password.data != field.data:
-      raise ValidationError('パスワードが一致しません')
-  
-  def validate_password(self, field):
+  def validate(self):
     """
-    パスワードのバリデーションメソッド。
+    フォームのバリデーションメソッド。
 
-    Args: field (PasswordField): パスワードの入力フィールド。
+    各フィールドの検証後、パスワードと確認用パスワードの一致を確認します。
 
-    Raises:
-      ValidationError: パスワードが10文字未満の場合に発生。
+    Returns:
+      bool: バリデーションの結果。Trueならバリデーション成功、Falseなら失敗。
     """
-    if len(field.data) < 10:
-      raise ValidationError('パスワードは10文字以上で入力してください')
+    if not super(FlaskForm, self).validate():
+      return False
+    return confirm_password_matches(self)
 
 class UserSearchForm(FlaskForm):
   """
@@ -176,7 +182,7 @@ class UserSearchForm(FlaskForm):
     submit (SubmitField): フォームの送信ボタン。
   """
   username = StringField(
-    'ユーザー名を入力してください', validators=[DataRequired()]
+    'ユーザー名を入力してください', validators=[REQUIRED]
   )
   submit = SubmitField('検索')
 
@@ -222,5 +228,5 @@ class MessageForm(FlaskForm):
     return True
   
 class ContactForm(FlaskForm):
-    body = TextAreaField('お問い合わせ内容', validators=[DataRequired()])
+    body = TextAreaField('お問い合わせ内容', validators=[REQUIRED])
     submit = SubmitField('送信')
\ No newline at end of file
@@ -1,23 +1,95 @@
 # models.py
 import secrets
-from flask import flash
-from flaskr import db, login_manager
-from flask_bcrypt import generate_password_hash, check_password_hash
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, flash, g
+from flaskr import db, login_manager, bcrypt, mail
 from flask_login import UserMixin, current_user
-from sqlalchemy.orm import aliased
-from sqlalchemy import and_, or_, desc
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, or_, desc, select, case, func, delete, update, tuple_, table, column, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from datetime import datetime, timedelta
-from uuid import uuid4
-from flask_mail import Message, Mail
+from flask_mail import Message
 
-mail = Mail()
+# SMTPの送信はリクエストの応答を待たせないよう、バックグラウンドのスレッドで行う
+_mail_executor = ThreadPoolExecutor(max_workers=2)
+
+def _send_mail_job(app, msg):
+  """
+  アプリケーションコンテキスト内でメールを送信します。(バックグラウンドスレッドで実行)
+
+  Args:
+    app (Flask): 送信に使うFlaskアプリケーション。
+    msg (Message): 送信するメール。
+
+  Returns: None
+  """
+  with app.app_context():
+    try:
+      mail.send(msg)
+    except Exception:
+      app.logger.exception('メールの送信に失敗しました')
+
+def send_mail_async(msg):
+  """
+  メールの送信をバックグラウンドのスレッドに任せ、すぐに戻ります。
+
+  Args:
+    msg (Message): 送信するメール。
+
+  Returns: None
+  """
+  # スレッド側ではcurrent_appが使えないため、実体のアプリケーションを渡す
+  _mail_executor.submit(_send_mail_job, current_app._get_current_object(), msg)
+
+# フレンド一覧などを1ページに表示する件数
+FRIENDS_PER_PAGE = 50
+# ユーザー名の全文検索用(trigram)の仮想テーブル。マイグレーションでトリガーとともに作成する
+users_fts = table('users_fts', column('rowid'))
+# trigramで検索できる最短の文字数。これより短い検索語はLIKEだけで絞り込む
+USERNAME_FTS_MIN_LENGTH = 3
+# users_ftsテーブルが存在するかどうか。プロセスごとに最初の検索で1度だけ確認する
+_users_fts_exists = None
+
+def users_fts_available():
+  """
+  全文検索用のusers_ftsテーブルが作成済みかどうかを返します。
+
+  マイグレーション(flask db upgrade)を実行していないデータベースでも検索できるよう、
+  テーブルがなければLIKEだけの検索に切り替えるために使います。
+
+  Returns:
+    bool: users_ftsテーブルが存在する場合はTrue。
+  """
+  global _users_fts_exists
+  if _users_fts_exists is None:
+    _users_fts_exists = db.session.execute(
+      text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_fts'")
+    ).first() is not None
+  return _users_fts_exists
 
 # userの情報を取得するための関数
 @login_manager.user_loader
 def load_user(user_id):
-  return User.query.get(int(user_id)) # Userクラスで定義したuserIDを取得
+  user_id = int(user_id)
+  # 同一リクエスト内ではgにキャッシュしたユーザーを返す
+  cache = g.setdefault('_user_cache', {})
+  if user_id not in cache:
+    # セッションのアイデンティティマップにあればSQLを発行せずに取得できる
+    cache[user_id] = db.session.get(User, user_id)
+  return cache[user_id]
+
+def current_user_id():
+  """
+  ログイン中のユーザーのIDを整数で返します。
+
+  Flask-Loginのプロキシを毎回たどらないよう、値はリクエスト中gにキャッシュします。
+
+  Returns:
+    int: ログイン中のユーザーのID。
+  """
+  if '_me_id' not in g:
+    g._me_id = int(current_user.get_id())
+  return g._me_id
 
 class User(UserMixin, db.Model):
   """
@@ -27,25 +99,48 @@ class User(UserMixin, db.Model):
     id (int): ユーザーの一意の識別子。
     username (str): ユーザーのユーザー名。
     email (str): ユーザーのメールアドレス。
-    password (str): ユーザーのハッシュ化されたパスワード。
+    password (str): ユーザーのハッシュ化されたパスワード。未設定の場合はNone。
     picture_path (str): ユーザーのプロフィール画像の保存先パス。
     is_active (bool): アカウントが有効か無効かを示すフラグ。
     create_at (datetime): ユーザーが作成された日時。
     update_at (datetime): ユーザー情報が最後に更新された日時。
+    connections_from (list of UserConnect): ユーザーが申請した接続情報。
+    connections_to (list of UserConnect): ユーザーが申請された接続情報。
   """
   __tablename__ = 'users'
+  # search_by_name を (username, id) の順にインデックスから読み、LIMIT件で止められるようにする
+  __table_args__ = (
+    db.Index(
+      'ix_users_active_username_id', 'username', 'id',
+      sqlite_where=db.text('is_active = 1')
+    ),
+  )
   
   id = db.Column(db.Integer, primary_key=True)
   username = db.Column(db.String(64), index=True)
   email = db.Column(db.String(64), unique=True, index=True)
-  password = db.Column(
-    db.String(128),
-    default = generate_password_hash(secrets.token_urlsafe(16)) # デフォルトパスワード
-  )
+  # 登録直後はNULL。パスワード設定用URLから save_new_password で設定する
+  password = db.Column(db.String(128))
   picture_path = db.Column(db.Text)
   is_active = db.Column(db.Boolean, unique=False, default=False)
+  # 日時は他のテーブルと同じくアプリ側のローカル時刻(datetime.now)で記録する
   create_at = db.Column(db.DateTime, default=datetime.now) # 管理者用
-  update_at = db.Column(db.DateTime, default=datetime.now) # テーブルの流れを確認する際に必要
+  update_at = db.Column(
+    db.DateTime, default=datetime.now, onupdate=datetime.now
+  ) # テーブルの流れを確認する際に必要
+  # 接続情報はselectinloadなどで明示的にロードする。暗黙の遅延ロード(N+1)はエラーにする
+  connections_from = db.relationship(
+    'UserConnect', foreign_keys='UserConnect.from_user_id',
+    lazy='raise', passive_deletes=True
+  )
+  connections_to = db.relationship(
+    'UserConnect', foreign_keys='UserConnect.to_user_id',
+    lazy='raise', passive_deletes=True
+  )
+  
+  # Flask-Loginが毎リクエスト参照する属性は、UserMixinのプロパティではなくクラス属性で持つ
+  # (is_authenticatedはis_activeを反映する必要があるため、UserMixinのプロパティのままにする)
+  is_anonymous = False
   
   def __init__(self, username, email):
     """
@@ -61,6 +156,15 @@ class User(UserMixin, db.Model):
     self.username = username
     self.email = email
 
+  def get_id(self):
+    """
+    Flask-Loginがセッションに保存するユーザーIDを返します。
+
+    Returns:
+      str: ユーザーIDの文字列。
+    """
+    return str(self.id)
+
   @classmethod
   def select_user_by_email(cls, email):
     """
@@ -70,8 +174,15 @@ class User(UserMixin, db.Model):
 
     Returns:
       User or None: メールアドレスに一致するユーザーオブジェクト。見つからない場合はNone.
+
+    Note:
+      同一リクエスト内ではバリデーションとビューで同じメールアドレスを何度も検索するため、
+      結果をflask.gにキャッシュしてDBへの問い合わせを1回にまとめる。
     """
-    return cls.query.filter_by(email=email).first()
+    cache = g.setdefault('_user_by_email_cache', {})
+    if email not in cache:
+      cache[email] = cls.query.filter_by(email=email).first()
+    return cache[email]
   
   def validate_password(self, password):
     """
@@ -82,8 +193,33 @@ class User(UserMixin, db.Model):
     Returns:
       bool: パスワードが一致する場合はTrue、それ以外はFalse.
     """
-    return check_password_hash(self.password, password)
+    if not self.password: # パスワード未設定のユーザーはログインできない
+      return False
+    if not bcrypt.check_password_hash(self.password, password):
+      return False
+    if self._needs_rehash():
+      # 設定より低いコストのハッシュは、平文が分かるこのタイミングで作り直す(保存は呼び出し側でコミット)
+      self.password = bcrypt.generate_password_hash(password).decode('utf-8')
+    return True
   
+  def _needs_rehash(self):
+    """
+    保存されているハッシュのコストが現在の設定(BCRYPT_LOG_ROUNDS)より低いかどうかを返します。
+
+    設定より高いコストのハッシュは、強度を下げないようそのまま残します。
+
+    Returns:
+      bool: ハッシュを作り直す必要がある場合はTrue。
+    """
+    password_hash = self.password
+    if isinstance(password_hash, bytes): # 以前はbytesのまま保存していた
+      password_hash = password_hash.decode('utf-8')
+    try:
+      rounds = int(password_hash.split('$')[2]) # $2b$12$... の12の部分
+    except (IndexError, ValueError): # bcrypt以外の形式は判定しない
+      return False
+    return rounds < current_app.config.get('BCRYPT_LOG_ROUNDS', 12)
+
   def create_new_user(self):
     """
     ユーザーオブジェクトをデータベースに追加するメソッド.
@@ -111,7 +247,7 @@ class User(UserMixin, db.Model):
       else:
         print("ユーザーが見つかりませんでした。")
     """
-    return cls.query.get(id)
+    return db.session.get(cls, int(id)) # アイデンティティマップにあればSQLを発行しない
   
   def save_new_password(self, new_password):
     """
@@ -126,123 +262,140 @@ class User(UserMixin, db.Model):
 
     Returns: None
     """
-    self.password = generate_password_hash(new_password)
+    self.password = bcrypt.generate_password_hash(new_password).decode('utf-8')
     self.is_active = True
   
-  # UserConnectとouterjoinで紐付ける
+  # UserConnectと1度だけouterjoinで紐付ける
   @classmethod
-  def search_by_name(cls, username, page=1):
+  def search_by_name(cls, username, last_username=None, last_id=None, per_page=5):
     """
     ユーザー名で検索して一致するユーザーを返します。
 
-    Args:username (str): 検索するユーザー名の一部または完全な文字列。
+    Args:
+      username (str): 検索するユーザー名の一部または完全な文字列。
+      last_username (str): 前のページの最後のユーザー名。(次のページを取得する際のカーソル)
+      last_id (int): 前のページの最後のユーザーID。(次のページを取得する際のカーソル)
+      per_page (int): 1ページに表示する件数。
 
     Returns:
-      list: 検索条件に一致するユーザーのリスト。各ユーザーはid、username、picture_pathの属性を持っています。
+      tuple: (ユーザーのリスト, 次のページがあるかどうか)。
+        各ユーザーはid、username、picture_pathの属性を持っています。
 
     Note:
       ユーザー名が指定された文字列を含む、かつ現在のログインユーザーのIDと異なり、
       かつアクティブなユーザーに対して検索が行われます。
-    """
-    user_connect1 = aliased(UserConnect) # from 検索相手のID,to ログインユーザーIDでUserConnectに紐付け
-    user_connect2 = aliased(UserConnect) # to 検索相手のID,from ログインユーザーIDでUserConnectに紐付け
-    # return cls.query.filter(
-    result = cls.query.filter(
-      cls.username.like(f'%{username}%'),
-      cls.id != int(current_user.get_id()),
+      (username, id) をカーソルにしたキーセットページネーションのため、
+      件数のCOUNTやOFFSETによる読み飛ばしは行いません。
+    """
+    me = current_user_id()
+    # 双方向の接続を1回の結合で取得し、向きごとのステータスを条件付き集計で取り出す
+    query = cls.query.filter(
+      # 入力値はバインドパラメータで渡し、%や_はワイルドカードとして扱わない
+      cls.username.contains(username, autoescape=True),
+      cls.id != me,
       cls.is_active == True
     ).outerjoin(
-      user_connect1,
-      and_(
-        user_connect1.from_user_id == cls.id, # 検索相手のID
-        user_connect1.to_user_id == current_user.get_id() # ログインユーザーID
-      )
-    ).outerjoin(
-      user_connect2,
-      and_(
-        user_connect2.from_user_id == current_user.get_id(),
-        user_connect2.to_user_id == cls.id
-      )
-    ).with_entities(
-      cls.id, cls.username, cls.picture_path,
-      user_connect1.status.label("joined_status_to_from"), # joined_status_to_from 別名で検索相手のステータスを取得
-      user_connect2.status.label("joined_status_from_to") # joined_status_from_to 別名でログインユーザーとのステータスを取得
-    ).order_by(cls.username).paginate(page=page, per_page=5, error_out=False)
-    
-    if not result.items:  # result.items が空（ユーザーが見つからなかった）場合
-      flash("お友達が見つからなかったよ。もう一度探してみてね！")
-    
-    return result
-    
-  @classmethod
-  def select_friends(cls):
-    """
-    クラスメソッド: select_friends()
-
-    現在のユーザーと2度繋がりがある友達を取得します。ユーザーの友達関係はUserConnectモデルを介して確認されます。
-    
-    Returns:
-      list: フレンドの情報を含むタプルのリスト。各タプルは (id, username, picture_path) の順で構成されます。
-    """
-    return cls.query.join(
       UserConnect,
       or_(
         and_(
-          UserConnect.to_user_id == cls.id,
-          UserConnect.from_user_id == current_user.get_id(),
-          UserConnect.status == 2
+          UserConnect.from_user_id == cls.id, # 検索相手のID
+          UserConnect.to_user_id == me # ログインユーザーID
         ),
         and_(
-          UserConnect.from_user_id == cls.id,
-          UserConnect.to_user_id == current_user.get_id(),
-          UserConnect.status == 2
+          UserConnect.from_user_id == me,
+          UserConnect.to_user_id == cls.id
         )
       )
     ).with_entities(
+      cls.id, cls.username, cls.picture_path,
+      # joined_status_to_from 別名で検索相手からのステータスを取得
+      func.max(
+        case((UserConnect.from_user_id == cls.id, UserConnect.status))
+      ).label("joined_status_to_from"),
+      # joined_status_from_to 別名でログインユーザーからのステータスを取得
+      func.max(
+        case((UserConnect.from_user_id == me, UserConnect.status))
+      ).label("joined_status_from_to")
+    )
+    if len(username) >= USERNAME_FTS_MIN_LENGTH and users_fts_available():
+      # 前方一致でないLIKEはインデックスを使えないため、先にtrigramの全文検索で候補を絞る
+      phrase = '"' + username.replace('"', '""') + '"'
+      query = query.filter(cls.id.in_(
+        select(users_fts.c.rowid).where(
+          text('users_fts MATCH :username_phrase').bindparams(username_phrase=phrase)
+        )
+      ))
+    if last_username is not None and last_id is not None:
+      # 前のページの最後の行より後ろから取得する
+      query = query.filter(tuple_(cls.username, cls.id) > tuple_(last_username, last_id))
+    # 1件多く取得し、次のページがあるかどうかを判定する
+    rows = query.group_by(
       cls.id, cls.username, cls.picture_path
-    ).all()
+    ).order_by(cls.username, cls.id).limit(per_page + 1).all()
+    users, has_next = rows[:per_page], len(rows) > per_page
+    
+    if not users and last_id is None:  # 最初のページでユーザーが見つからなかった場合
+      flash("お友達が見つからなかったよ。もう一度探してみてね！")
+    
+    return users, has_next
     
   @classmethod
-  def select_requested_friends(cls):
+  def select_all_connections(
+    cls, friends_after=0, requested_after=0, requesting_after=0,
+    limit_value=FRIENDS_PER_PAGE
+  ):
     """
-    クラスメソッド: select_requested_friends()
+    クラスメソッド: select_all_connections()
 
-    現在のユーザーから友達リクエストが送られているユーザーを取得します。ユーザーの友達関係はUserConnectモデルを介して確認されます。
-    
-    Returns:
-      list: リクエストが送られている友達の情報を含むタプルのリスト。各タプルは (id, username, picture_path) の順で構成されます。
-    """
-    return cls.query.join(
-      UserConnect,
-      and_(
-        UserConnect.from_user_id == cls.id, # UserテーブルのidとUserConnectテーブルのfrom_user_idで結合条件を指定
-        UserConnect.to_user_id == current_user.get_id(), # UserConnectテーブルのto_user_idと現在のユーザーのIDで結合条件を指定
-        UserConnect.status == 1 # UserConnectテーブルのstatusカラムが1である条件を指定
-      )
-    ).with_entities(
-      cls.id,  cls.username, cls.picture_path # 取得するカラムを指定
-    ).all()
-  
-  @classmethod  
-  def select_requesting_friends(cls):
-    """
-    クラスメソッド: select_requesting_friends()
+    現在のユーザーのフレンド、届いた申請、申請済みのユーザーを1回の問い合わせでまとめて取得します。
+    ユーザーの友達関係はUserConnectモデルを介して確認されます。
+
+    Args:
+      friends_after (int): フレンド一覧で、このIDより大きいユーザーだけを取得する。(続きを表示する際のカーソル)
+      requested_after (int): 届いた申請一覧で、このIDより大きいユーザーだけを取得する。
+      requesting_after (int): 申請済み一覧で、このIDより大きいユーザーだけを取得する。
+      limit_value (int): 一覧ごとに取得する最大件数。
 
-    現在のユーザーが送信した友達リクエストが保留中のユーザーを取得します。ユーザーの友達関係はUserConnectモデルを介して確認されます。
-    
     Returns:
-      list: リクエストが保留中の友達の情報を含むタプルのリスト。各タプルは (id, username, picture_path) の順で構成されます。
-    """
-    return cls.query.join(
+      dict: 'friends'(フレンド)、'requested'(届いた申請)、'requesting'(申請済み)をキーとし、
+        (id, username, picture_path) の行のリストを値とする辞書。
+    """
+    me = current_user_id()
+    # status=2はフレンド、status=1は申請の向きで届いた申請か申請済みかを分ける
+    bucket = case(
+      (UserConnect.status == 2, 'friends'),
+      (UserConnect.to_user_id == me, 'requested'),
+      else_='requesting'
+    )
+    subquery = db.session.query(
+      cls.id, cls.username, cls.picture_path, bucket.label('bucket'),
+      # 一覧ごとにIDの昇順で番号を振り、件数の上限に使う
+      func.row_number().over(
+        partition_by=bucket, order_by=cls.id
+      ).label('row_number')
+    ).join(
       UserConnect,
-      and_(
-        UserConnect.from_user_id == current_user.get_id(),
-        UserConnect.to_user_id == cls.id,
-        UserConnect.status == 1
+      or_(
+        and_(UserConnect.from_user_id == me, UserConnect.to_user_id == cls.id),
+        and_(UserConnect.from_user_id == cls.id, UserConnect.to_user_id == me)
       )
-    ).with_entities(
-      cls.id,  cls.username, cls.picture_path
-    ).all()
+    ).filter(
+      # IDをカーソルにしてOFFSETを使わずに、一覧ごとの続きを取得する
+      or_(
+        and_(UserConnect.status == 2, cls.id > friends_after),
+        and_(UserConnect.status == 1, UserConnect.to_user_id == me, cls.id > requested_after),
+        and_(UserConnect.status == 1, UserConnect.from_user_id == me, cls.id > requesting_after)
+      )
+    ).subquery()
+    rows = db.session.query(
+      subquery.c.id, subquery.c.username, subquery.c.picture_path, subquery.c.bucket
+    ).filter(
+      subquery.c.row_number <= limit_value
+    ).order_by(subquery.c.id).all()
+    connections = {'friends': [], 'requested': [], 'requesting': []}
+    for row in rows:
+      connections[row.bucket].append(row)
+    return connections
       
 class PasswordResetToken(db.Model):
   """
@@ -264,13 +417,20 @@ class PasswordResetToken(db.Model):
     db.String(64),
     unique=True,
     index=True,
-    default=lambda: str(uuid4) # uuidの値をランダムに生成
+    default=lambda: secrets.token_urlsafe(32) # CSPRNGで256ビットのランダムな値を生成
   )
   # usersテーブルと紐付ける外部キー
   user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-  expire_at = db.Column(db.DateTime, default=lambda: datetime.now() + timedelta(days=1)) # トークン有効時間
+  # 遅延ロードによる追加のSELECTを防ぐため、明示的にロードしない場合はエラーにする
+  user = db.relationship('User', lazy='raise')
+  expire_at = db.Column(
+    db.DateTime,
+    # get_user_id_by_token / prune_expired と同じローカル時刻で比較するため、DB側の既定値は持たない
+    default=lambda: datetime.now() + timedelta(days=1),
+    index=True # prune_expired の範囲削除で全件走査しないようにする
+  ) # トークン有効時間
   create_at = db.Column(db.DateTime, default=datetime.now)
-  update_at = db.Column(db.DateTime, default=datetime.now)
+  update_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
   
   def __init__(self, token, user_id, expire_at):
     """
@@ -297,16 +457,18 @@ class PasswordResetToken(db.Model):
       str: 生成されたパスワードリセットトークン。
 
     Example:
-      user = User.query.get(1)  # 実際のユーザー取得ロジックに置き換える
+      user = User.select_user_by_id(1)  # 実際のユーザー取得ロジックに置き換える
       token = PasswordResetToken.publish_token(user)
     """
-    token = str(uuid4()) # 一意のトークンを生成
-    new_token = cls(
-      token,
-      user.id,
-      datetime.now() + timedelta(days=1) # 有効期限を現在の時刻から1日後に設定
+    token = secrets.token_urlsafe(32) # 一意のトークンを生成
+    # ORMの変更追跡を通さず、Coreのinsertで1行を直接追加する
+    db.session.execute(
+      cls.__table__.insert().values(
+        token=token,
+        user_id=user.id,
+        expire_at=datetime.now() + timedelta(days=1) # 有効期限を現在の時刻から1日後に設定
+      )
     )
-    db.session.add(new_token) # 新しいトークンをデータベースセッションに追加
     return token # 生成されたトークンを返す
   
   @classmethod
@@ -324,27 +486,43 @@ class PasswordResetToken(db.Model):
     body = f'パスワード設定用URLをお送りします。下記よりパスワードの設定をお願いします。\nパスワード設定用URL : https://chappli-sns-0d74a523aa4b.herokuapp.com//reset_password/{token}'
     # body = f'パスワード設定用URLをお送りします。下記よりパスワードの設定をお願いします。\nパスワード設定用URL : http://127.0.0.0:5000/reset_password/{token}'
     msg = Message(subject, recipients=[email], body=body)
-    mail.send(msg)
+    send_mail_async(msg)
     
   @classmethod
   def get_user_id_by_token(cls, token):
     """
-    トークンに対応するユーザーIDを取得。
+    トークンに対応するユーザーIDとユーザーを取得。
 
     与えられたトークンが存在し、かつ有効期限が現在時刻よりも後である場合、
-    トークンに対応するユーザーIDを返します。
+    トークンに対応するユーザーIDとユーザーを返します。
+    ユーザーはJOINで同時に取得するため、問い合わせは1回で済みます。
 
     Args:
       cls (User): クラス自体。
       token (str): 検索対象のトークン。
 
     Returns:
-      int or None: トークンに対応するユーザーIDが見つかれば返します。
-        見つからない場合はNoneが返されます。
+      tuple: (ユーザーID, Userクラスのインスタンス)。
+        見つからない場合は(None, None)が返されます。
+
+    Note:
+      有効期限の判定もSQLの条件に含めているため、存在しないトークンと期限切れのトークンは
+      同じ1回の問い合わせで同じ結果(None, None)になり、応答時間から区別できません。
     """
+    # 現在時刻は1回だけ評価してバインドパラメータとして渡す
+    # (expire_at はアプリ側のローカル時刻で保存しているため、DB側のfunc.now()とは比較しない)
     now = datetime.now()
-    record = cls.query.filter_by(token=str(token)).filter(cls.expire_at > now).first()
-    return record.user_id if record else None # recordがNoneでないことの確認
+    # トークン自体はORMのインスタンスにせず、ユーザーIDとユーザーだけを取得する
+    # tokenはルートで文字列として受け取っているため、そのまま比較する
+    record = db.session.execute(
+      select(cls.user_id, User).join(cls.user).where(
+        cls.token == token,
+        cls.expire_at > now
+      )
+    ).first()
+    if not record: # recordがNoneでないことの確認
+      return None, None
+    return record.user_id, record.User
   
   @classmethod
   def delete_token(cls, token):
@@ -356,8 +534,26 @@ class PasswordResetToken(db.Model):
       token (str): 削除対象のトークン。
 
     Returns: None
+
+    Note:
+      コミットは呼び出し側で行います。
     """
-    cls.query.filter_by(token=str(token)).delete()
+    cls.query.filter_by(token=token).delete(synchronize_session=False)
+
+  @classmethod
+  def prune_expired(cls):
+    """
+    有効期限切れのトークンをまとめて削除します。
+
+    期限切れのトークンが溜まり続けてテーブルとインデックスが肥大化するのを防ぎます。
+
+    Args:
+      cls (PasswordResetToken): クラス自体。
+
+    Returns: None
+    """
+    # ORMを通さず、1回のDELETE文で期限切れの行をまとめて削除する
+    db.session.execute(delete(cls).where(cls.expire_at < datetime.now()))
     db.session.commit()
 
 class UserConnect(db.Model):
@@ -374,13 +570,20 @@ class UserConnect(db.Model):
   """
   
   __tablename__ = 'user_connects'
+  # 同じ向きの接続は1件だけにし、申請の重複をデータベースで防ぐ(申請元からの検索にも使う)
+  # 逆向きは(申請先, 申請元, ステータス)の組み合わせで、インデックスだけで絞り込む
+  # 先頭のカラムで from_user_id / to_user_id 単独の検索もまかなえるため、単一カラムのインデックスは作らない
+  __table_args__ = (
+    db.Index('uq_uc_from_to', 'from_user_id', 'to_user_id', unique=True),
+    db.Index('ix_uc_to_from_status', 'to_user_id', 'from_user_id', 'status'),
+  )
   
   id = db.Column(db.Integer, primary_key=True)
   from_user_id = db.Column(
-    db.Integer, db.ForeignKey('users.id'), index=True
+    db.Integer, db.ForeignKey('users.id')
   )
   to_user_id = db.Column(
-    db.Integer, db.ForeignKey('users.id'), index=True
+    db.Integer, db.ForeignKey('users.id')
   )
   status = db.Column(db.Integer, unique=False, default=1)
   create_at = db.Column(db.DateTime, default=datetime.now)
@@ -397,59 +600,101 @@ class UserConnect(db.Model):
     self.from_user_id = from_user_id
     self.to_user_id = to_user_id
   
-  def create_new_connect(self):
-    db.session.add(self)
-    
   @classmethod
-  def select_by_from_user_id(cls, from_user_id):
+  def create_new_connect(cls, to_user_id):
     """
-    from_user_idおよび現在のユーザーのIDに基づいてUserConnectのインスタンスを取得するクラスメソッド。
+    現在のユーザーから指定されたユーザーへの接続申請を作成するクラスメソッド。
+
+    申請済みかどうかをSELECTで確認する代わりに、INSERT ... ON CONFLICT DO NOTHING の1回の問い合わせで行い、
+    同じ向きの接続が既にあれば何もしません。
 
     Args:
-      from_user_id (int): 取得する接続情報の発信元ユーザーのID。
+      to_user_id (int): 申請先のユーザーのID。
 
     Returns:
-      UserConnect or None: 指定された条件に一致するUserConnectのインスタンス。条件に一致するものがない場合はNone。
-    """
-    return cls.query.filter_by(
-      from_user_id = from_user_id,
-      to_user_id = current_user.get_id()
-    ).first()
+      bool: 申請を作成した場合はTrue、既に接続があった場合や自分自身への申請の場合はFalse。
+
+    Note:
+      コミットは呼び出し側で行います。
+    """
+    me, to_user_id = current_user_id(), int(to_user_id)
+    if to_user_id == me: # 自分自身への接続は作らない
+      return False
+    result = db.session.execute(
+      sqlite_insert(cls).values(
+        from_user_id=me, to_user_id=to_user_id
+      ).on_conflict_do_nothing(index_elements=['from_user_id', 'to_user_id'])
+    )
+    return result.rowcount > 0
     
-  def update_status(self):
+  @classmethod
+  def accept_request(cls, from_user_id):
     """
-    UserConnectのステータスを更新し、最終更新日時を現在の日時に更新するメソッド。
+    指定されたユーザーから現在のユーザーへの申請中の接続を承認するクラスメソッド。
 
-    ステータスを2に設定し、更新が行われた時点の日時をupdate_at属性に設定します。
-    """
-    self.status = 2
-    self.update_at = datetime.now()
+    接続情報を取得してから更新する代わりに、1回のUPDATEでステータスを1から2に更新し、
+    最終更新日時を現在の日時にします。
+
+    Args:
+      from_user_id (int): 申請を行ったユーザーのID。
+
+    Returns:
+      bool: 承認した接続があればTrue、申請中の接続がなければFalse。
+
+    Note:
+      コミットは呼び出し側で行います。
+    """
+    result = db.session.execute(
+      update(cls).where(
+        cls.from_user_id == int(from_user_id),
+        cls.to_user_id == current_user_id(),
+        cls.status == 1
+      ).values(status=2, update_at=datetime.now()),
+      execution_options={'synchronize_session': False}
+    )
+    return result.rowcount > 0
     
   @classmethod
   def is_friend(cls, to_user_id):
     """
     指定されたユーザーが現在のユーザーと友達関係にあるかどうかを判定するクラスメソッド。
 
+    行を取得せずにEXISTSで判定するため、該当する行が1件見つかった時点で検索が終わります。
+    結果はリクエスト中gにキャッシュされます。
+
     Args: to_user_id (int): 判定対象のユーザーのID。
 
     Returns:
       bool: 指定されたユーザーが友達関係にある場合はTrue、それ以外の場合はFalse。
-    """
-    user = cls.query.filter(
-      or_(
-        and_(
-          UserConnect.from_user_id == current_user.get_id(),
-          UserConnect.to_user_id == to_user_id,
-          UserConnect.status == 2
-        ),
-        and_(
-          UserConnect.from_user_id == to_user_id,
-          UserConnect.to_user_id == current_user.get_id(),
-          UserConnect.status == 2
-        )
-      )
-    ).first()
-    return True if user else False
+
+    Note:
+      2人のIDを(小さい方, 大きい方)に並べ替えて比較するため、申請の向きに関係なく
+      ix_uc_pair_status インデックスの1回の検索で判定できます。
+      (SQLiteでは2引数のmin/maxがLEAST/GREATESTに相当します)
+    """
+    try:
+      to_user_id = int(to_user_id)
+    except (TypeError, ValueError): # IDとして解釈できない値は友達ではない
+      return False
+    me = current_user_id()
+    cache = g.setdefault('_is_friend_cache', {})
+    if to_user_id not in cache:
+      exists_query = db.session.query(cls.id).filter(
+        func.min(cls.from_user_id, cls.to_user_id) == min(me, to_user_id),
+        func.max(cls.from_user_id, cls.to_user_id) == max(me, to_user_id),
+        cls.status == 2
+      ).exists()
+      cache[to_user_id] = bool(db.session.query(exists_query).scalar())
+    return cache[to_user_id]
+
+# 向きを問わない2人の組み合わせを(小さいID, 大きいID)に正規化し、is_friend を1回の検索で判定する
+# 式インデックスはカラムを参照するため、クラス定義の後で宣言する
+db.Index(
+  'ix_uc_pair_status',
+  func.min(UserConnect.from_user_id, UserConnect.to_user_id),
+  func.max(UserConnect.from_user_id, UserConnect.to_user_id),
+  UserConnect.status
+)
 
 class TalkMessage(db.Model):
   """
@@ -467,6 +712,15 @@ class TalkMessage(db.Model):
   """
   
   __tablename__ = 'messages'
+  # 2人の間のメッセージをid順に取得する際、並べ替えなしでインデックスを走査する
+  __table_args__ = (
+    db.Index('ix_msg_pair_id', 'from_user_id', 'to_user_id', 'id'),
+    # 未読・未確認メッセージの取得を、並べ替えなしでインデックスの範囲検索だけで行う
+    db.Index(
+      'ix_msg_pair_unread',
+      'to_user_id', 'from_user_id', 'is_read', 'is_checked', 'id'
+    ),
+  )
   
   id = db.Column(db.Integer, primary_key=True)
   from_user_id = db.Column(
@@ -490,20 +744,23 @@ class TalkMessage(db.Model):
     db.session.add(self)
     
   @classmethod
-  def get_friend_messages(cls, id1, id2, offset_value=0, limit_value=50):
+  def get_friend_messages(cls, id1, id2, before_id=None, limit_value=50):
     """
     指定された2つのユーザー間でのメッセージを取得するクラスメソッド。
 
+    OFFSETで読み飛ばす代わりに、取得済みの最も古いメッセージIDより前を取得する(キーセットページネーション)ため、
+    過去にさかのぼっても取得コストが増えません。
+
     Args:
       id1 (int): ユーザー1のID。
       id2 (int): ユーザー2のID。
-      offset_value (int, optional): 取得開始位置のオフセット値。デフォルトは0。
+      before_id (int, optional): このIDより前のメッセージを取得する。デフォルトはNone(最新から取得)。
       limit_value (int, optional): 取得するメッセージの上限数。デフォルトは50。
 
     Returns:
-      list of TalkMessage: 指定された2つのユーザー間でのメッセージを時系列順に取得したリスト。
+      list of TalkMessage: 指定された2つのユーザー間でのメッセージを新しい順に取得したリスト。
     """
-    return cls.query.filter(
+    query = cls.query.filter(
       or_(
         and_(
           cls.from_user_id == id1,
@@ -514,74 +771,46 @@ class TalkMessage(db.Model):
           cls.to_user_id == id1
         )
       )
-    ).order_by(desc(cls.id)).offset(offset_value).limit(limit_value).all()
-  
-  @classmethod
-  def update_is_read_by_ids(cls, ids):
-    """
-    指定されたメッセージIDのメッセージの既読状態を更新するクラスメソッド。
-
-    Args: ids (list of int): 既読状態を更新するメッセージのIDリスト。
-
-    Returns: None
-    """
-    cls.query.filter(cls.id.in_(ids)).update(
-      { 'is_read': 1 },
-      synchronize_session='fetch'
     )
+    if before_id is not None:
+      query = query.filter(cls.id < before_id)
+    return query.order_by(desc(cls.id)).limit(limit_value).all()
   
   @classmethod
-  def update_is_checked_by_ids(cls, ids):
+  def update_read_and_checked(cls, me_id, peer_id):
     """
-    指定されたメッセージIDのメッセージの確認状態を更新するクラスメソッド。
+    相手からの未読メッセージを既読にし、自分の既読メッセージを確認済みにするクラスメソッド。
 
-    Args: ids (list of int): 確認状態を更新するメッセージのIDリスト。
-
-    Returns: None
-    """
-    cls.query.filter(cls.id.in_(ids)).update(
-      { 'is_checked': 1 },
-      synchronize_session='fetch'
-    )
-    
-  @classmethod
-  def select_not_read_messages(cls, from_user_id, to_user_id):
-    """
-    指定されたユーザー間で未読のメッセージを取得するクラスメソッド。
+    2つの更新を UPDATE ... SET ... = CASE ... RETURNING の1回の問い合わせにまとめます。
 
     Args:
-      from_user_id (int): 未読メッセージの発信元ユーザーのID。
-      to_user_id (int): 未読メッセージの受信先ユーザーのID。
+      me_id (int): ログイン中のユーザーのID。
+      peer_id (int): メッセージの相手のユーザーID。
 
-    Returns: list of TalkMessage: 指定されたユーザー間で未読のメッセージを取得したリスト。
-    """
-    return cls.query.filter(
-      and_(
-        cls.from_user_id == from_user_id,
-        cls.to_user_id == to_user_id,
-        cls.is_read == 0
-      )
-    ).order_by(cls.id).all()
-  
-  @classmethod
-  def select_not_checked_messages(cls, from_user_id, to_user_id):
-    """
-    指定されたユーザー間で未確認の既読メッセージを取得するクラスメソッド。
-
-    Args:
-      from_user_id (int): 未確認メッセージの発信元ユーザーのID。
-      to_user_id (int): 未確認メッセージの受信先ユーザーのID。
+    Returns:
+      tuple: (既読にしたメッセージを古い順に並べたリスト, 確認済みにしたメッセージのIDのリスト)
 
-    Returns: list of TalkMessage: 指定されたユーザー間で未確認の既読メッセージを取得したリスト。
-    """
-    return cls.query.filter(
-      and_(
-        cls.from_user_id == from_user_id,
-        cls.to_user_id == to_user_id,
-        cls.is_read == 1,
-        cls.is_checked == 0
-      )
-    ).order_by(cls.id).all()
+    Note:
+      コミットは呼び出し側で行います。RETURNINGの順序は保証されないため、IDで並べ替えます。
+    """
+    # RETURNINGの行はPython側でfrom_user_idと比較して振り分けるため、IDは整数にそろえる
+    me_id, peer_id = int(me_id), int(peer_id)
+    to_read = and_(cls.from_user_id == peer_id, cls.to_user_id == me_id, cls.is_read == 0)
+    to_check = and_(
+      cls.from_user_id == me_id, cls.to_user_id == peer_id,
+      cls.is_read == 1, cls.is_checked == 0
+    )
+    messages = db.session.execute(
+      update(cls).where(or_(to_read, to_check)).values(
+        is_read=case((cls.from_user_id == peer_id, 1), else_=cls.is_read),
+        is_checked=case((cls.from_user_id == me_id, 1), else_=cls.is_checked)
+      ).returning(cls),
+      execution_options={'synchronize_session': False}
+    ).scalars().all()
+    messages.sort(key=lambda message: message.id)
+    read_messages = [message for message in messages if message.from_user_id == peer_id]
+    checked_message_ids = [message.id for message in messages if message.from_user_id == me_id]
+    return read_messages, checked_message_ids
 
 class UserContact(db.Model):
   """
@@ -623,8 +852,8 @@ class UserContact(db.Model):
     email_body += f'問い合わせ内容:\n{inquiry}'
     # メールを作成
     msg = Message(subject=subject, recipients=[recipient_email], body=email_body)
-    # メールを送信
-    mail.send(msg)
+    # メールを送信 (応答を待たせないようバックグラウンドで送る)
+    send_mail_async(msg)
   
   def create_new_contact(self):
     db.session.add(self)
\ No newline at end of file
@@ -1,57 +1,97 @@
+import re
 from flask import url_for
-from jinja2.utils import urlize
+from markupsafe import escape
 from flask_login import current_user
 from flaskr.utils.template_filters import replace_newline
+from flaskr.models import current_user_id
 
+# URLを見つける正規表現。import時に1回だけコンパイルする
+# (末尾の句読点や閉じ括弧はURLに含めない)
+_URL_RE = re.compile(r'''(https?://[^\s<>"]*[^\s<>".,;:!?)\]'、。])''')
+
+def urlize(text):
+  """
+  文字列をHTMLエスケープし、含まれるURLをリンクに変換します。
+
+  jinja2のurlizeは複数回の正規表現処理を行うため、メッセージ表示では1つの正規表現だけで処理します。
+
+  Args:
+    text (str): 変換する文字列。
+
+  Returns:
+    str: エスケープ済みでURLがリンクになったHTML。
+  """
+  # 分割するとURLは奇数番目に入る
+  parts = _URL_RE.split(text)
+  for i, part in enumerate(parts):
+    if i % 2:
+      url = escape(part)
+      parts[i] = f'<a href="{url}" rel="noopener">{url}</a>'
+    else:
+      parts[i] = str(escape(part))
+  return ''.join(parts)
+
+# HTMLは文字列の連結を繰り返さず、リストに追加して最後に1回だけ結合する
 def make_message_format(user, messages):
-  message_tag = ''
+  parts = []
+  append = parts.append
+  # ループ内で毎回url_forを呼ばないよう、画像のURLは1回だけ作る
+  user_image = url_for("static", filename=user.picture_path) if user.picture_path else None
+  # ユーザー名はHTMLとして解釈されないよう、ループの前に1回だけエスケープする
+  username = escape(user.username)
   for message in messages:
-    message_tag += '<div class="col-lg-1 col-md-1 col-sm-2 col-2">'
-    if user.picture_path:
-      message_tag += f'<img class="user-image-mini" src={ url_for("static", filename=user.picture_path) }'
-    message_tag += f'''
-      <p>{ user.username }</p>
+    append('<div class="col-lg-1 col-md-1 col-sm-2 col-2">')
+    if user_image:
+      append(f'<img class="user-image-mini" src="{ user_image }">')
+    append(f'''
+      <p>{ username }</p>
       </div>
       <div class="speech-bubble-dest col-lg-4 col-md-7 col-sm-6 col-6">
-    '''
+    ''')
     for splitted_message in replace_newline(message.message):
-      message_tag += f'<p>{ urlize(splitted_message) }<p>'
-    message_tag += '''
+      append(f'<p>{ urlize(splitted_message) }</p>')
+    append('''
       </div>
       <div class="col-lg-7 col-md-3 col-sm-4 col-4"></div>
-    '''
-  return message_tag
+    ''')
+  return ''.join(parts)
 
 def make_old_message_format(user, messages):
-  message_tag = ''
-  for message in messages[::-1]:
-    if message.from_user_id == int(current_user.get_id()):
-      message_tag += f'<div id="self-message-tag-{message.id}" class="col-lg-1 offset-lg-6 col-md-1 offset-md-3 col-sm-2 offset-sm-2 col-2 offset-2">'
+  parts = []
+  append = parts.append
+  me_id = current_user_id()
+  user_image = url_for("static", filename=user.picture_path) if user.picture_path else None
+  my_image = url_for("static", filename=current_user.picture_path) if current_user.picture_path else None
+  username = escape(user.username)
+  my_username = escape(current_user.username)
+  for message in reversed(messages): # コピーを作らずに古い順にたどる
+    if message.from_user_id == me_id:
+      append(f'<div id="self-message-tag-{message.id}" class="col-lg-1 offset-lg-6 col-md-1 offset-md-3 col-sm-2 offset-sm-2 col-2 offset-2">')
       if message.is_checked:
-        message_tag += '<p class="text-end">既読</p>'
-      message_tag += '</div>'
-      message_tag += '<div class="speech-bubble-self col-lg-4 col-md-7 col-sm-6 col-6">'
+        append('<p class="text-end">既読</p>')
+      append('</div>')
+      append('<div class="speech-bubble-self col-lg-4 col-md-7 col-sm-6 col-6">')
       for splitted_message in replace_newline(message.message):
-        message_tag += f'<p>{ urlize(splitted_message) }</p>'
-      message_tag += '</div>'
-      message_tag += '<div class="col-lg-1 col-md-1 col-sm-2 col-2">'
-      if current_user.picture_path:
-        message_tag += f'<img class="user-image-mini" src={ url_for("static", filename=current_user.picture_path) }>'
-      message_tag += f'<p>{ current_user.username }</p>'
-      message_tag += '</div>'
+        append(f'<p>{ urlize(splitted_message) }</p>')
+      append('</div>')
+      append('<div class="col-lg-1 col-md-1 col-sm-2 col-2">')
+      if my_image:
+        append(f'<img class="user-image-mini" src="{ my_image }">')
+      append(f'<p>{ my_username }</p>')
+      append('</div>')
     else:
-      message_tag += '<div class="col-lg-1 col-md-1 col-sm-2 col-2">'
-      if user.picture_path:
-        message_tag += f'<img class="user-image-mini" src={ url_for("static", filename=user.picture_path) }'
-      message_tag += f'''
-        <p>{ user.username }</p>
+      append('<div class="col-lg-1 col-md-1 col-sm-2 col-2">')
+      if user_image:
+        append(f'<img class="user-image-mini" src="{ user_image }">')
+      append(f'''
+        <p>{ username }</p>
         </div>
         <div class="speech-bubble-dest col-lg-4 col-md-7 col-sm-6 col-6">
-      '''
+      ''')
       for splitted_message in replace_newline(message.message):
-        message_tag += f'<p>{ urlize(splitted_message) }<p>'
-      message_tag += '''
+        append(f'<p>{ urlize(splitted_message) }</p>')
+      append('''
         </div>
         <div class="col-lg-7 col-md-3 col-sm-4 col-4"></div>
-      '''
-  return message_tag
+      ''')
+  return ''.join(parts)
@@ -1,11 +1,17 @@
 # views.py
-from datetime import datetime
+import os
+import shutil
+import time
+from urllib.parse import urlencode
 from flask import (
   Blueprint, abort, request, render_template,
-  redirect, url_for, flash, session, jsonify
+  redirect, url_for, flash, session, jsonify, make_response
 )
 from flask_login import login_user, login_required, logout_user, current_user
-from flaskr.models import User, PasswordResetToken, UserConnect, TalkMessage, UserContact
+from flaskr.models import (
+  User, PasswordResetToken, UserConnect, TalkMessage, UserContact, FRIENDS_PER_PAGE,
+  current_user_id
+)
 from flaskr import db
 
 from flaskr.forms import (
@@ -13,11 +19,18 @@ from flaskr.forms import (
   UserForm, ChangePasswordForm, UserSearchForm, ConnectForm, MessageForm,
   ContactForm
 )
-from flask_mail import Mail, Message
 from flaskr.utils.message_format import make_message_format, make_old_message_format
 
 bp = Blueprint('app', __name__, url_prefix='')
-mail = Mail()
+# サンプルデータ削除用の一覧を1ページに表示する件数
+ADMIN_LIST_PER_PAGE = 50
+# プロフィール画像を書き出す際のバッファサイズ
+PICTURE_COPY_BUFFER_SIZE = 1024 * 1024
+# 未ログイン時のホーム画面はユーザーごとの内容を含まないため、描画結果をプロセス内で使い回す
+# (url_forの結果はアプリケーションのマウント位置で変わるため、script_rootごとに保持する)
+_anonymous_home_cache = {}
+# 未ログイン時のホーム画面をブラウザにキャッシュさせる秒数
+ANONYMOUS_HOME_MAX_AGE = 60
 
 @bp.route('/')
 def home():
@@ -27,19 +40,36 @@ def home():
   Returns:
     HTML: ホーム画面のHTMLテンプレート。
   """
-  friends = requested_friends = requesting_friends = None
+  if not current_user.is_authenticated:
+    html = _anonymous_home_cache.get(request.script_root)
+    if html is None:
+      html = _anonymous_home_cache[request.script_root] = render_template('home.html')
+    response = make_response(html)
+    response.cache_control.public = True
+    response.cache_control.max_age = ANONYMOUS_HOME_MAX_AGE
+    # ログインするとセッションCookieが変わるため、ログイン後にキャッシュされた画面が使われることはない
+    response.vary.add('Cookie')
+    return response
+  # 値が変わるときだけ書き込み、セッションCookieの再署名とSet-Cookieを省く
+  if session.get('url') != 'app.home':
+    session['url'] = 'app.home'
+  # 3つの一覧を1回の問い合わせで取得する。各一覧はIDをカーソルにして続きを表示する
+  connections = User.select_all_connections(
+    friends_after=request.args.get('friends_after', 0, type=int),
+    requested_after=request.args.get('requested_after', 0, type=int),
+    requesting_after=request.args.get('requesting_after', 0, type=int)
+  )
+  friends = connections['friends']
+  requested_friends = connections['requested']
+  requesting_friends = connections['requesting']
   connect_form = ConnectForm()
-  session['url'] = 'app.home'
-  if current_user.is_authenticated:
-    friends = User.select_friends()
-    requested_friends = User.select_requested_friends()
-    requesting_friends = User.select_requesting_friends()
   return render_template(
     'home.html', 
     friends = friends,
     requested_friends = requested_friends,
     requesting_friends = requesting_friends,
-    connect_form = connect_form
+    connect_form = connect_form,
+    per_page = FRIENDS_PER_PAGE
   )
 
 @bp.route('/logout')
@@ -68,6 +98,7 @@ def login():
     # ユーザーが存在し、アクティブであり、かつパスワードが正しい場合
     if user and user.is_active and user.validate_password(form.password.data):
       login_user(user, remember=True) # ユーザーをログイン状態にし、セッションに保存
+      db.session.commit() # パスワードのハッシュを作り直した場合は保存する
       next_url = request.args.get('next', url_for('app.home'))
       # ログイン成功後に指定されたリダイレクト先URLにリダイレクト
       return redirect(next_url)
@@ -75,7 +106,7 @@ def login():
       flash('このユーザーは存在しません')
     elif not user.is_active: # ユーザーが存在するが無効な場合
       flash('無効なユーザーです。パスワードを再設定してください。')
-    elif not user.validate_password(form.password.data):
+    else: # 上の条件で検証済みのため、bcryptを再度実行しない
       # ユーザーが存在し、アクティブであるが、パスワードが間違っている場合
       flash(f'パスワードが間違っているよ。もう一度入力してみて！<br>もし忘れたら下のリンクからパスワードの再設定してね')
   # ログインが失敗したか、GETリクエストの場合はログイン画面を表示
@@ -104,12 +135,12 @@ def register():
       username = form.username.data,
       email = form.email.data
     )
+    # ユーザーの登録とトークンの生成は1つのトランザクションにまとめ、コミットは1回だけ行う
     with db.session.begin(nested=True):
       # DBに新規ユーザーを登録
       user.create_new_user()
-    db.session.commit()
-    # パスワードリセットトークンを生成
-    with db.session.begin(nested=True):
+      db.session.flush() # トークンに紐付けるユーザーIDを確定する
+      # パスワードリセットトークンを生成
       token = PasswordResetToken.publish_token(user)
     db.session.commit()
     email = user.email
@@ -121,25 +152,24 @@ def register():
   # バリデーションが失敗した場合、register.htmlを再度表示
   return render_template('register.html', form=form)
 
-@bp.route('/reset_password/<uuid:token>', methods=['GET', 'POST'])
+@bp.route('/reset_password/<string:token>', methods=['GET', 'POST'])
 def reset_password(token):
   """
   パスワードリセットを処理するルート関数。
 
   Args:
-    token (uuid): パスワードリセットのトークン。
+    token (str): パスワードリセットのトークン。
 
   Returns:
     HTML: パスワードリセット画面のHTMLテンプレート。
   """
   form = ResetPasswordForm(request.form)
-  # PasswordResetTokenクラスのトークンからユーザーidを取得
-  reset_user_id = PasswordResetToken.get_user_id_by_token(token)
+  # PasswordResetTokenクラスのトークンからユーザーidとユーザーを取得
+  reset_user_id, user = PasswordResetToken.get_user_id_by_token(token)
   if not reset_user_id:
     abort(500) # 存在しない場合はHTTPステータスコードの500を返す
   if request.method == 'POST' and form.validate():
     password = form.password.data # 新しいパスワードの取得
-    user = User.select_user_by_id(reset_user_id) # DBから対応するユーザーを取得
     # トランザクション内でDBとのセッションを開始
     with db.session.begin(nested=True):
       user.save_new_password(password) # 新しいパスワードをユーザーオブジェクトに保存
@@ -218,12 +248,15 @@ def user():
     with db.session.begin(nested=True):
       user.username = form.username.data
       user.email = form.email.data
-      file = request.files[form.picture_path.name].read()
-      if file:
-        file_name = user_id + ' ' + \
-          str(int(datetime.now().timestamp())) + '.jpg'
-        picture_path = 'flaskr/static/user_image/' + file_name
-        open(picture_path, 'wb').write(file)
+      file = request.files.get(form.picture_path.name)
+      if file: # ファイルが選択されている場合 (ファイル名が空なら読み込まない)
+        file_name = f'{user_id} {int(time.time())}.jpg'
+        picture_path = f'flaskr/static/user_image/{file_name}'
+        # 全体をメモリに読み込まずに一時ファイルへ書き出し、書き終えてから置き換える
+        tmp_path = picture_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+          shutil.copyfileobj(file.stream, f, PICTURE_COPY_BUFFER_SIZE)
+        os.replace(tmp_path, picture_path)
         user.picture_path = 'user_image/' + file_name
     db.session.commit()
     flash('ユーザー情報を更新しました')
@@ -292,16 +325,23 @@ def user_search():
   """
   form = UserSearchForm(request.form)
   connect_form = ConnectForm()
-  session['url'] = 'app.user_search'
+  if session.get('url') != 'app.user_search':
+    session['url'] = 'app.user_search'
   users = None
   user_name = request.args.get('username', None, type=str)
   next_url = prev_url = None
   if user_name:
-    page = request.args.get('page', 1, type=int)
-    posts = User.search_by_name(user_name, page)
-    next_url = url_for('app.user_search', page=posts.next_num, username=user_name) if posts.has_next else None
-    prev_url = url_for('app.user_search', page=posts.prev_num, username=user_name) if posts.has_prev else None
-    users = posts.items
+    # 前のページの最後の (username, id) をカーソルとして受け取る
+    last_username = request.args.get('last_username', None, type=str)
+    last_id = request.args.get('last_id', None, type=int)
+    users, has_next = User.search_by_name(user_name, last_username, last_id)
+    # URLマップの探索は1回だけ行い、ページ送りのリンクはクエリ文字列を付け足して作る
+    search_url = url_for('app.user_search')
+    next_url = f'{search_url}?' + urlencode({
+      'username': user_name, 'last_username': users[-1].username, 'last_id': users[-1].id
+    }) if has_next else None
+    # キーセット方式では前のページを逆算しないため、最初のページへ戻るリンクにする
+    prev_url = f'{search_url}?' + urlencode({'username': user_name}) if last_id is not None else None
     # UserテーブルとUserConnectテーブルを紐付け、statusを確認する
     # from 自分のID, to 相手のID, status=1:自分から申請中
     # to 自分のID, from 相手のID, status=1:相手から申請中
@@ -326,21 +366,20 @@ def connect_user():
   form = ConnectForm(request.form)
   if request.method == 'POST' and form.validate():
     if form.connect_condition.data == 'connect':
-      new_connect = UserConnect(current_user.get_id(), form.to_user_id.data)
+      # 二重送信などで申請が重複しても、既存の接続はそのまま残す
       with db.session.begin(nested=True):
-        new_connect.create_new_connect()
+        UserConnect.create_new_connect(form.to_user_id.data)
       db.session.commit()
     elif form.connect_condition.data == 'accept':
-      # 相手から自分へのUserConnectを取得
-      connect = UserConnect.select_by_from_user_id(form.to_user_id.data)
-      if connect:
-        with db.session.begin(nested=True):
-          connect.update_status() # statusを1から2へ更新
-        db.session.commit()
-  next_url = session.pop('url', 'app:home')
+      # 相手から自分への申請中のUserConnectのstatusを1から2へ更新(該当がなければ何もしない)
+      with db.session.begin(nested=True):
+        UserConnect.accept_request(form.to_user_id.data)
+      db.session.commit()
+  # popすると次の画面表示で再び書き込みが必要になるため、値は残したまま参照する
+  next_url = session.get('url', 'app.home')
   return redirect(url_for(next_url))
 
-@bp.route('/message/<id>', methods=['GET', 'POST'])
+@bp.route('/message/<int:id>', methods=['GET', 'POST'])
 @login_required
 def message(id):
   """
@@ -357,31 +396,20 @@ def message(id):
   if not UserConnect.is_friend(id):
     return redirect(url_for('app.home'))
   form = MessageForm(request.form)
-  # フレンドのメッセージを取得
-  messages = TalkMessage.get_friend_messages(current_user.get_id(), id)
-  user = User.select_user_by_id(id)
-  # 未読メッセージを取得
-  read_message_ids = [message.id for message in messages if (not message.is_read) and (message.from_user_id == int(id))]
-  not_checked_message_ids = [message.id for message in messages if message.is_read and (not message.is_checked) and (message.from_user_id == int(current_user.get_id()))]
-  if not_checked_message_ids:
-    # with db.session() as session:
-    #   with session.begin_nested():
-    #     TalkMessage.update_is_checked_by_id(not_checked_message_ids)
-    # db.session.commit()
-    with db.session.begin(nested=True):
-      TalkMessage.update_is_checked_by_ids(not_checked_message_ids)
-    db.session.commit()
-  # read_message_idsのis_readをTrueに変更
-  if read_message_ids:
-    with db.session.begin(nested=True):
-      TalkMessage.update_is_read_by_ids(read_message_ids)
-    db.session.commit()
-  if request.method == 'POST' and form.validate():
-    new_message = TalkMessage(current_user.get_id(), id, form.message.data)
-    with db.session.begin(nested=True):
-      new_message.create_message()
-    db.session.commit()
+  me = current_user_id()
+  is_sent = request.method == 'POST' and form.validate()
+  # 既読・確認済みの更新とメッセージの送信は1つのトランザクションにまとめ、コミットは1回だけ行う
+  with db.session.begin(nested=True):
+    # 相手からの未読メッセージを既読に、自分の既読メッセージを確認済みにする(1回のUPDATEで行う)
+    TalkMessage.update_read_and_checked(me, id)
+    if is_sent:
+      TalkMessage(me, id, form.message.data).create_message()
+  db.session.commit()
+  if is_sent:
     return redirect(url_for('app.message', id=id)) # 保存したメッセージを取得
+  # 更新後に取得するため、コミットで破棄された属性を1件ずつ読み直すことがない
+  messages = TalkMessage.get_friend_messages(me, id)
+  user = User.select_user_by_id(id)
   return render_template(
     'message.html', form=form, messages=messages, to_user_id=id, user=user,
     # photo_image=photo_image
@@ -399,24 +427,22 @@ def message_ajax():
     jsonify: 未読メッセージと未チェックメッセージの情報をJSON形式で返します。
   """
   user_id = request.args.get('user_id', -1, type=int)
-  # 未読メッセージを取得
-  user = User.select_user_by_id(user_id)
-  # 相手から自分への未読メッセージ
-  not_read_messages = TalkMessage.select_not_read_messages(user_id, current_user.get_id())
-  # 未読メッセージのidのみを取得
-  not_read_message_ids = [message.id for message in not_read_messages]
-  if not_read_message_ids:
-    with db.session.begin(nested=True):
-      TalkMessage.update_is_read_by_ids(not_read_message_ids)
-    db.session.commit()
-  # 自分の既読メッセージで未チェックを取得
-  not_checked_messages = TalkMessage.select_not_checked_messages(current_user.get_id(), user.id)
-  not_checked_message_ids = [not_checked_message.id for not_checked_message in not_checked_messages]
-  if not_checked_message_ids:
-    with db.session.begin(nested=True):
-      TalkMessage.update_is_checked_by_ids(not_checked_message_ids)
+  # 既読・確認済みの更新は1つのトランザクションにまとめ、コミットは1回だけ行う
+  with db.session.begin(nested=True):
+    # 相手から自分への未読メッセージを既読にして取得し、
+    # 自分の既読メッセージで未チェックのものを確認済みにしてそのIDを取得する(UPDATE ... RETURNINGの1回で行う)
+    not_read_messages, not_checked_message_ids = TalkMessage.update_read_and_checked(
+      current_user_id(), user_id
+    )
+  if not not_read_messages and not not_checked_message_ids:
+    # ポーリングの大半は新着がないため、相手ユーザーを取得せずに空の結果を返す
     db.session.commit()
-  return jsonify(data=make_message_format(user, not_read_messages), checked_message_ids = not_checked_message_ids)
+    return jsonify(data='', checked_message_ids=[])
+  # 本文はレスポンスで使うため、コミットで属性が破棄される前にHTMLにしておく
+  message_tags = make_message_format(User.select_user_by_id(user_id), not_read_messages) \
+    if not_read_messages else ''
+  db.session.commit()
+  return jsonify(data=message_tags, checked_message_ids = not_checked_message_ids)
 
 @bp.route('/load_old_messages', methods=['GET'])
 @login_required
@@ -424,18 +450,23 @@ def load_old_messages():
   """
   過去のメッセージの読み込みに関する処理を行う関数。
 
-  Ajaxリクエストで送られたユーザーIDとオフセット値に基づいて、過去のメッセージを取得して返します。
+  Ajaxリクエストで送られたユーザーIDと表示済みの最も古いメッセージIDに基づいて、
+  それより前のメッセージを取得して返します。
 
   Returns:
-    jsonify: 過去のメッセージの情報をJSON形式で返します。
+    jsonify: 過去のメッセージの情報と、取得した中で最も古いメッセージIDをJSON形式で返します。
+      パラメータが不正な場合は、本文なしのステータスコード204を返します。
   """
   user_id = request.args.get('user_id', -1, type=int)
-  offset_value = request.args.get('offset_value', -1, type=int)
-  if user_id == -1 or offset_value == -1:
-    return
-  messages = TalkMessage.get_friend_messages(current_user.get_id(), user_id, offset_value * 50)
+  before_id = request.args.get('before_id', -1, type=int)
+  if user_id <= 0 or before_id <= 0:
+    return '', 204
+  messages = TalkMessage.get_friend_messages(current_user_id(), user_id, before_id)
+  if not messages: # これ以上古いメッセージがなければ相手ユーザーを取得しない
+    return jsonify(data='', oldest_id=None)
   user = User.select_user_by_id(user_id)
-  return jsonify(data=make_old_message_format(user, messages))
+  oldest_id = messages[-1].id
+  return jsonify(data=make_old_message_format(user, messages), oldest_id=oldest_id)
 
 # お問い合わせを追加
 @bp.route('/contact', methods=['GET', 'POST'])
@@ -481,36 +512,48 @@ def server_error(e):
 # サンプルデータ削除用ユーザー一覧
 @bp.route('/users')
 def user_list():
-  users = User.query.all()
-  return render_template('user_list.html', users=users)
+  # テンプレートで使う列だけを、IDをカーソルにして一定件数ずつ取得する
+  after_id = request.args.get('after_id', 0, type=int)
+  users = User.query.with_entities(
+    User.id, User.username, User.email
+  ).filter(User.id > after_id).order_by(User.id).limit(ADMIN_LIST_PER_PAGE).all()
+  return render_template('user_list.html', users=users, per_page=ADMIN_LIST_PER_PAGE)
 # サンプルデータ削除用メソッド
 @bp.route('/users/<int:id>/delete', methods=['POST'])
 def user_delete(id):
-  user = User.query.get(id)
+  user = db.session.get(User, id)
   db.session.delete(user)
   db.session.commit()
   return redirect(url_for('app.user_list'))
 # サンプルデータ削除用トークン一覧
 @bp.route('/tokens')
 def token_list():
-  tokens = PasswordResetToken.query.all()
-  return render_template('token_list.html', tokens=tokens)
+  after_id = request.args.get('after_id', 0, type=int)
+  tokens = PasswordResetToken.query.with_entities(
+    PasswordResetToken.id, PasswordResetToken.token
+  ).filter(PasswordResetToken.id > after_id).order_by(
+    PasswordResetToken.id
+  ).limit(ADMIN_LIST_PER_PAGE).all()
+  return render_template('token_list.html', tokens=tokens, per_page=ADMIN_LIST_PER_PAGE)
 # サンプルトークン削除用メソッド
 @bp.route('/tokens/<int:id>/delete', methods=['POST'])
 def token_delete(id):
-  token = PasswordResetToken.query.get(id)
+  token = db.session.get(PasswordResetToken, id)
   db.session.delete(token)
   db.session.commit()
   return redirect(url_for('app.token_list'))
 # サンプルコネクト削除用コネクト一覧
 @bp.route('/connects')
 def connect_list():
-  connects = UserConnect.query.all()
-  return render_template('connect_list.html', connects=connects)
+  after_id = request.args.get('after_id', 0, type=int)
+  connects = UserConnect.query.with_entities(
+    UserConnect.id, UserConnect.from_user_id, UserConnect.to_user_id, UserConnect.status
+  ).filter(UserConnect.id > after_id).order_by(UserConnect.id).limit(ADMIN_LIST_PER_PAGE).all()
+  return render_template('connect_list.html', connects=connects, per_page=ADMIN_LIST_PER_PAGE)
 # サンプルコネクト削除用メソッド
 @bp.route('/connects/<int:id>/delete', methods=['POST'])
 def connect_delete(id):
-  connect = UserConnect.query.get(id)
+  connect = db.session.get(UserConnect, id)
   db.session.delete(connect)
   db.session.commit()
   return redirect(url_for('app.connect_list'))
@@ -0,0 +1,50 @@
+"""users fts
+
+Revision ID: e81b6f4a9d03
+Revises: d05f8a3b6c21
+Create Date: 2026-10-15 22:31:17.845390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e81b6f4a9d03'
+down_revision = 'd05f8a3b6c21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # ユーザー名の部分一致検索用の全文検索テーブル(SQLite FTS5, trigram)
+    op.execute(
+        "CREATE VIRTUAL TABLE users_fts USING fts5("
+        "username, content='users', content_rowid='id', tokenize='trigram')"
+    )
+    # usersテーブルの変更を全文検索テーブルに反映する
+    op.execute(
+        "CREATE TRIGGER users_fts_ai AFTER INSERT ON users BEGIN "
+        "INSERT INTO users_fts(rowid, username) VALUES (new.id, new.username); "
+        "END"
+    )
+    op.execute(
+        "CREATE TRIGGER users_fts_ad AFTER DELETE ON users BEGIN "
+        "INSERT INTO users_fts(users_fts, rowid, username) VALUES ('delete', old.id, old.username); "
+        "END"
+    )
+    op.execute(
+        "CREATE TRIGGER users_fts_au AFTER UPDATE OF username ON users BEGIN "
+        "INSERT INTO users_fts(users_fts, rowid, username) VALUES ('delete', old.id, old.username); "
+        "INSERT INTO users_fts(rowid, username) VALUES (new.id, new.username); "
+        "END"
+    )
+    # 既存のユーザーを索引に登録する
+    op.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS users_fts_au")
+    op.execute("DROP TRIGGER IF EXISTS users_fts_ad")
+    op.execute("DROP TRIGGER IF EXISTS users_fts_ai")
+    op.execute("DROP TABLE IF EXISTS users_fts")